@@ -7,30 +7,50 @@ Links that don't return 200 HTTP status are also checked
 via a video host API (e.g. YouTube Data API v3)
 for a more precise unavailability reason.
 
-Requires Python 3.6+ with requests and bs4 libraries and a Google API key.
+Requires Python 3.6+ with requests, lxml and orjson libraries
+and a Google API key.
 """
 
 import argparse
 import csv
+import io
 import itertools
 import logging
 import re
+import socket
 import sys
 import urllib.parse
-from collections.abc import Collection, Generator, Iterable
-from copy import copy
+from collections import defaultdict, deque
+from collections.abc import Callable, Collection, Generator, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+from lxml.etree import XPath
+from requests.adapters import HTTPAdapter
+
+from html_utils import XP_LAST_PAGE, has_class, parse_streamed
+from video_host_utils import (
+    MAX_BATCH_SIZE,
+    RETRY,
+    TIMEOUT,
+    USER_AGENT,
+    VIDEO_HOSTS,
+    extract_all_video_ids,
+    yt_api_key,
+)
 
 PATH_LOG = 'find_dead.log'
 PATH_OUT = 'result.md'
 PATH_CHECKED_USERS = 'checked_users.txt'
+URL_ICM = 'https://www.icheckmovies.com/'
 URL_USER_COMMENTS = 'https://www.icheckmovies.com/profiles/comments/'
 URL_CHARTS = 'https://www.icheckmovies.com/charts/profiles/'
 URL_USERS_BY_CHECKS = 'https://www.icheckmovies.com/profiles/?sort=checks'
+MAX_WORKERS = 8  # concurrent page fetches; must not exceed the pool size
+MAX_IN_FLIGHT = 2 * MAX_WORKERS  # pages fetched ahead of their processing
 
 try:
     script_path = Path(__file__).resolve().parent
@@ -42,11 +62,12 @@ except NameError:
 
 
 class CustomFormatter(logging.Formatter):
-    def format(self, record):
-        # the same LogRecord instance is sent to all handlers
-        record = copy(record)
-        record.msg = record.msg.strip()
-        return super().format(record).strip()
+    def formatMessage(self, record):  # noqa: N802
+        # The same LogRecord instance is sent to all handlers, but every
+        # formatter recomputes record.message, so stripping it here keeps
+        # the console output intact without copying the record.
+        record.message = record.message.strip()
+        return super().formatMessage(record)
 
 
 logger = logging.getLogger()
@@ -62,98 +83,239 @@ logger.addHandler(console_handler)
 for lib in ['requests', 'urllib3']:
     logging.getLogger(lib).setLevel(logging.WARNING)
 
+# ----- HTTP session setup -----
+
+
+class PinnedDNSAdapter(HTTPAdapter):
+    """An adapter that looks up each host's address only once per process.
+
+    New connections (e.g. after keep-alive expiry) go straight to the cached
+    address instead of asking DNS again. SNI, the Host header and
+    certificate verification still use the real hostname.
+
+    Only IPv4 addresses are pinned: a host without one is looked up
+    as usual, i.e. again for every new connection.
+    """
+
+    def __init__(self, **kwargs):
+        self.addresses: dict[str, str] = {}
+        super().__init__(**kwargs)
+
+    def resolve(self, host: str, port: int) -> str | None:
+        if host not in self.addresses:
+            try:
+                info = socket.getaddrinfo(
+                    host, port, socket.AF_INET, socket.SOCK_STREAM
+                )
+            except OSError:
+                return None  # let urllib3 do a regular lookup and fail
+            self.addresses[host] = info[0][4][0]
+        return self.addresses[host]
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        attrs = super().build_connection_pool_key_attributes(
+            request, verify, cert
+        )
+        host_params, pool_kwargs = attrs
+        host, port = host_params['host'], host_params['port'] or 443
+        address = host_params['scheme'] == 'https' and self.resolve(host, port)
+        if address:
+            host_params['host'] = address
+            pool_kwargs['server_hostname'] = host
+            pool_kwargs['assert_hostname'] = host
+        return host_params, pool_kwargs
+
+    def add_headers(self, request, **kwargs):
+        # otherwise the pinned address would be sent as the Host header
+        url = urllib.parse.urlsplit(request.url)
+        if url.scheme == 'https' and url.hostname in self.addresses:
+            request.headers['Host'] = url.netloc
+
+    def send(self, request, **kwargs):
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            # a redirect copies the headers of this request to the next hop,
+            # which may be another host
+            request.headers.pop('Host', None)
+
+
+# A single session for the whole process keeps connections to ICM alive
+# between requests instead of doing a TCP+TLS handshake for every page.
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = USER_AGENT
+SESSION.mount(
+    URL_ICM,
+    PinnedDNSAdapter(
+        pool_connections=4,
+        pool_maxsize=2 * MAX_WORKERS,
+        max_retries=RETRY,
+    ),
+)
+
+# One worker pool for the whole process, shared by all page fetches, so
+# threads are started once instead of for every user.
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS, thread_name_prefix='fetch'
+)
+
+
+def map_concurrently[T, R](
+    fn: Callable[[T], R], items: Iterable[T]
+) -> Generator[R, None, None]:
+    """Run a function over items on the shared pool, yielding in order.
+
+    At most MAX_IN_FLIGHT items are submitted ahead of the consumer, so
+    results of a long run don't pile up in memory while it is busy.
+    Items that haven't started yet are cancelled if the consumer stops early.
+    """
+    items = iter(items)
+    futures = deque(
+        EXECUTOR.submit(fn, item)
+        for item in itertools.islice(items, MAX_IN_FLIGHT)
+    )
+    try:
+        while futures:
+            result = futures.popleft().result()
+            # keep the pool busy while the consumer handles this result
+            for item in itertools.islice(items, 1):
+                futures.append(EXECUTOR.submit(fn, item))
+            yield result
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+# ----- HTML parsing setup -----
+
+
+# Compiled once; string results don't need to keep their tree alive.
+XP_COMMENTS = XPath(
+    f"//*[{has_class('comment')}][not(*[{has_class('highlightBlock')}])]"
+)
+XP_MOVIE = XPath(f".//*[{has_class('link')}]//a/@href", smart_strings=False)
+XP_TEXT = XPath(
+    f"string(.//*[{has_class('span-18')}]/span)", smart_strings=False
+)
+XP_PROFILES = XPath(f"//*[{has_class('listItemProfile')}]//h2//a")
+
+
 # ----- Main -----
 
 try:
-    from video_host_utils import VIDEO_HOSTS
+    yt_api_key()  # fail before crawling anything, not at the first check
 except FileNotFoundError as e:
     logger.exception('Google API key is missing.')
     print(*e.args)
     sys.exit(1)
 
 
-def number_of_pages(user: str) -> int:
-    """Get the total number of comment pages of an ICM user."""
-    r = requests.get(URL_USER_COMMENTS, {'user': user})
-    if r.status_code != requests.codes.ok:
-        logger.error(
-            f"Error while fetching the first page of {user}'s comments: "
-            f'HTTP error {r.status_code}'
-        )
-        return 0
-    if '/login/' in r.url:
-        logger.error(f"User {user} doesn't exist.")
-        return 0
-    soup = BeautifulSoup(r.text, 'html.parser')
-    paginator = soup.select('.pages li a')
-    if paginator:
-        return int(paginator[-1].get_text())
-    if len(soup.select('.comment')) == 0:
-        return 0
-    return 1
-
-
-def parse_comment(comment: Tag):
+def number_of_pages(user: str) -> tuple[int, list[lxml.html.HtmlElement]]:
+    """Get the total number of comment pages of an ICM user.
+
+    Comments from the first page are returned as well, since that page
+    has to be fetched anyway.
+    """
+    with SESSION.get(
+        URL_USER_COMMENTS,
+        params={'user': user},
+        stream=True,
+        timeout=TIMEOUT,
+    ) as r:
+        if r.status_code != requests.codes.ok:
+            logger.error(
+                f"Error while fetching the first page of {user}'s comments: "
+                f'HTTP error {r.status_code}'
+            )
+            return 0, []
+        if '/login/' in r.url:
+            logger.error(f"User {user} doesn't exist.")
+            return 0, []
+        tree = parse_streamed(r)
+    comments = XP_COMMENTS(tree)
+    last_page = XP_LAST_PAGE(tree)
+    if last_page:
+        return int(last_page), comments
+    if not comments:
+        return 0, []
+    return 1, comments
+
+
+def parse_comment(comment: lxml.html.HtmlElement):
     """Extract a movie url and all video ids from an ICM comment."""
-    movie = comment.select_one('.link a')
-    if movie:
-        movie = movie['href']
-    text = comment.select_one('.span-18 > span')
-    text = text.get_text() if text else ''
+    movies = XP_MOVIE(comment)
+    movie = movies[0] if movies else None
+    text = XP_TEXT(comment)
     # TODO(monk-time): fix the line above for comments with no text, e.g.:
     # "<span><iframe allowfullscreen="" frameborder="0" height="310"
     # width="508" src="http://www.youtube.com/embed/0qFS5IEctis?wmode=opaque"
     # title="YouTube video player"></iframe></span>"
-    for host in VIDEO_HOSTS:
-        ids = VIDEO_HOSTS[host].extract(text)
-        if ids:
-            for vid in ids:
-                yield movie, host, vid
+    for host, vid in extract_all_video_ids(text):
+        yield movie, host, vid
 
 
-def comments_in_profile_page(*, user: str, page: int) -> list[Tag]:
+def comments_in_profile_page(
+    *, user: str, page: int
+) -> list[lxml.html.HtmlElement]:
     """Get comments of an ICM user from one page of their profile."""
-    r = requests.get(URL_USER_COMMENTS, {'user': user, 'page': page})
-    logger.info(f"Checking {user}'s page #{page}")
-    if r.status_code != requests.codes.ok:
-        logger.error(f'Page #{page}: HTTP error {r.status_code}')
-        return []
-    soup = BeautifulSoup(r.text, 'html.parser')
-
-    def exclude_login_warning(tag):
-        return not tag.find_all(class_='highlightBlock', recursive=False)
-
-    return soup.find_all(exclude_login_warning, class_='comment')
+    with SESSION.get(
+        URL_USER_COMMENTS,
+        params={'user': user, 'page': page},
+        stream=True,
+        timeout=TIMEOUT,
+    ) as r:
+        logger.info(f"Checking {user}'s page #{page}")
+        if r.status_code != requests.codes.ok:
+            logger.error(f'Page #{page}: HTTP error {r.status_code}')
+            return []
+        tree = parse_streamed(r)
+    # excludes the login warning, which is also styled as a comment
+    return XP_COMMENTS(tree)
 
 
 def comments_in_profile(
     *, user: str, from_: int = 1, to: int
-) -> Generator[Tag, None, None]:
+) -> Generator[lxml.html.HtmlElement, None, None]:
     """Get all comments of an ICM user.
 
     Comments may be limited to a subrange (inclusive) of their pages.
+    Pages are fetched concurrently, but comments are yielded in page order.
     """
-    for page in range(from_, to + 1):
-        yield from comments_in_profile_page(user=user, page=page)
+    pages = map_concurrently(
+        lambda page: comments_in_profile_page(user=user, page=page),
+        range(from_, to + 1),
+    )
+    for comments in pages:
+        yield from comments
 
 
-def dead_in_comments(comments: Iterable[Tag]):
+def dead_in_comments(comments: Iterable[lxml.html.HtmlElement]):
     """Find all dead video links in the given comment elements.
 
     Supports comments that have several links.
+    Videos are checked in batches, so hosts with a batch API
+    (e.g. YouTube) need one request per batch instead of one per video.
     """
     comments_with_video = itertools.chain.from_iterable(
         map(parse_comment, comments)
     )
-    for movie, host, vid in comments_with_video:
-        status = VIDEO_HOSTS[host].get_status(vid)
-        if status == 'ok':
-            logger.debug(f'[{host}] {vid} on {movie}: OK')
-            continue
-        logger.warning(f'[{host}] {vid} on {movie}: {status}')
-        if status == 'not found':
-            status = None
-        yield movie, host, vid, status
+    for batch in itertools.batched(comments_with_video, MAX_BATCH_SIZE):
+        vids_by_host = defaultdict(list)
+        for _, host, vid in batch:
+            vids_by_host[host].append(vid)
+        statuses = {
+            host: VIDEO_HOSTS[host].get_statuses(vids)
+            for host, vids in vids_by_host.items()
+        }
+        for movie, host, vid in batch:
+            status = statuses[host][vid]
+            if status == 'ok':
+                logger.debug(f'[{host}] {vid} on {movie}: OK')
+                continue
+            logger.warning(f'[{host}] {vid} on {movie}: {status}')
+            if status == 'not found':
+                status = None
+            yield movie, host, vid, status
 
 
 def write_dead_in_profile(*, user: str, from_: int = 1, to: int = 0):
@@ -162,26 +324,41 @@ def write_dead_in_profile(*, user: str, from_: int = 1, to: int = 0):
     Fetch all comment pages unless a subrange (inclusive) is provided.
     """
     logger.info(f'\nChecking {user}...')
-    to = to or number_of_pages(user)
+    first_page = []
+    if not to:
+        to, first_page = number_of_pages(user)
     if to > 0:
         logger.info(f'Got {to} pages of comments')
-    comments = comments_in_profile(user=user, from_=from_, to=to)
-    dead_links = list(dead_in_comments(comments))
-    if not dead_links:
+    if from_ == 1 and first_page:
+        logger.info(f"Checking {user}'s page #1")
+        comments = itertools.chain(
+            first_page, comments_in_profile(user=user, from_=2, to=to)
+        )
+    else:
+        comments = comments_in_profile(user=user, from_=from_, to=to)
+    # the header needs the total count, so links are formatted as they are
+    # found and the block is written out once they're all known
+    body = io.StringIO()
+    n_dead = 0
+    for movie, host, vid, status in dead_in_comments(comments):
+        status_text = f'**({status})** ' if status else ''
+        body.write(
+            f'- [{host}:{vid}]({VIDEO_HOSTS[host].url.format(vid)}) '
+            f'{status_text}on '
+            f'[{movie}](https://www.icheckmovies.com{movie}comments/)\n'
+        )
+        n_dead += 1
+    if not n_dead:
         return
-    with (script_path / PATH_OUT).open(mode='a', encoding='utf-8') as f:
+    with (script_path / PATH_OUT).open(
+        mode='a', buffering=1 << 16, encoding='utf-8'
+    ) as f:
         f.write(
             f'## [{user}]({URL_USER_COMMENTS}'
             f'?user={urllib.parse.quote_plus(user)}) '
-            f'({len(dead_links)})\n'
+            f'({n_dead})\n'
         )
-        for movie, host, vid, status in dead_links:
-            status_text = f'**({status})** ' if status else ''
-            f.write(
-                f'- [{host}:{vid}]({VIDEO_HOSTS[host].url.format(vid)}) '
-                f'{status_text}on '
-                f'[{movie}](https://www.icheckmovies.com{movie}comments/)\n'
-            )
+        f.write(body.getvalue())
 
 
 def top_users(
@@ -192,19 +369,24 @@ def top_users(
         f'Fetching {to - from_ + 1} pages of users from ICM '
         f'(starting from #{from_})...'
     )
-    for page in range(from_, to + 1):
-        url = URL_USERS_BY_CHECKS if by_all_checks else URL_CHARTS
-        r = requests.get(url, {'page': page})
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, 'html.parser')
-        for t in soup.select('.listItemProfile h2 a'):
-            yield t.get_text(strip=True)
+    url = URL_USERS_BY_CHECKS if by_all_checks else URL_CHARTS
+
+    def users_on_page(page: int) -> list[str]:
+        with SESSION.get(
+            url, params={'page': page}, stream=True, timeout=TIMEOUT
+        ) as r:
+            r.raise_for_status()
+            tree = parse_streamed(r)
+        return [t.text_content().strip() for t in XP_PROFILES(tree)]
+
+    for users in map_concurrently(users_on_page, range(from_, to + 1)):
+        yield from users
 
 
 def filter_by_blacklist(users: Iterable[str]):
     """Exclude users listed in a blacklist file."""
     with (script_path / PATH_CHECKED_USERS).open(encoding='utf-8') as f:
-        checked_users = [s.strip() for s in f if s.strip()]
+        checked_users = {s.strip() for s in f if s.strip()}
     yield from (u for u in users if u not in checked_users)
 
 
@@ -233,14 +415,29 @@ def write_dead_by_users(
                 f.write(user + '\n')
 
 
+RE_COUNT = re.compile(r' \((\d+)\)\n')
+RE_HEADER = re.compile(
+    r'^## \[(?P<author>.+?)]\((?P<author_url>.+?)\) \((?P<count>\d+)\)'
+)
+RE_ROW = re.compile(
+    r"""
+    ^-\s\[(?P<host>\w+):.+?]
+    \((?P<video_url>.+?)\)
+    (?:\s\*\*\((?P<blocked>blocked\severywhere)\)\*\*)?\s
+    on.+\((?P<comment_url>.+)\)$
+""",
+    re.VERBOSE,
+)
+
+
 def sort_output_file(filename=PATH_OUT):
     """Sort users in the output file by the number of their dead links desc."""
     with (script_path / filename).open(encoding='utf-8') as f:
         blocks = ['##' + s for s in f.read().split('##') if s]
-    blocks_with_lens = [
-        (b, int(re.search(r' \((\d+)\)\n', b).group(1))) for b in blocks
-    ]
-    blocks_with_lens.sort(key=lambda t: (-t[1], t[0]))
+    blocks_with_lens = [(b, int(RE_COUNT.search(b).group(1))) for b in blocks]
+    # both sorts are stable, so ties on the count stay ordered by text
+    blocks_with_lens.sort(key=itemgetter(0))
+    blocks_with_lens.sort(key=itemgetter(1), reverse=True)
     with (script_path / filename).open(mode='w', encoding='utf-8') as f:
         f.writelines(b[0] for b in blocks_with_lens)
 
@@ -249,44 +446,47 @@ def sort_output_file(filename=PATH_OUT):
 
 
 def convert_output_file_to_csv(filename=PATH_OUT):
-    """Convert the output file to a .CSV format."""
-    with (script_path / filename).open(encoding='utf-8') as f:
-        blocks = ['##' + s for s in f.read().split('##') if s]
-
-    re_header = re.compile(
-        r'^## \[(?P<author>.+?)]\((?P<author_url>.+?)\) \((?P<count>\d+)\)'
-    )
-    re_row = re.compile(
-        r"""
-        ^-\s\[(?P<host>\w+):.+?]
-        \((?P<video_url>.+?)\)
-        (?:\s\*\*\((?P<blocked>blocked\severywhere)\)\*\*)?\s
-        on.+\((?P<comment_url>.+)\)$
-    """,
-        re.VERBOSE,
-    )
-
-    full_rows = []
-    for block in blocks:
-        [first_line, *lines] = block.strip().split('\n')
-        author = re_header.match(first_line).groupdict()
-        rows = [re_row.match(line).groupdict() for line in lines]
-
-        assert len(rows) == int(author['count'])
-        del author['count']
-        full_rows.extend({**author, **row} for row in rows)
+    """Convert the output file to a .CSV format.
 
+    Works line by line, so memory use does not depend on the file size.
+    """
     csv_path = script_path / Path(filename).with_suffix('.csv')
-    with csv_path.open(mode='w', newline='', encoding='utf-8') as f:
-        fieldnames = ['author', 'comment_url', 'host', 'video_url', 'blocked']
-        writer = csv.DictWriter(f, fieldnames, extrasaction='ignore')
-        writer.writeheader()
-        for row in full_rows:
-            writer.writerow(row)
+    n_rows = 0
+    author, n_expected, n_author_rows = None, 0, 0
+    with (
+        (script_path / filename).open(encoding='utf-8') as f_md,
+        csv_path.open(
+            mode='w', newline='', encoding='utf-8', buffering=1 << 20
+        ) as f_csv,
+    ):
+        writer = csv.writer(f_csv)
+        writer.writerow(
+            ('author', 'comment_url', 'host', 'video_url', 'blocked')
+        )
+        for line in f_md:
+            if not line.strip():
+                continue
+            if line.startswith('## '):
+                assert n_author_rows == n_expected
+                header = RE_HEADER.match(line)
+                author, n_expected = header['author'], int(header['count'])
+                n_author_rows = 0
+                continue
+            row = RE_ROW.match(line)
+            writer.writerow(
+                (
+                    author,
+                    row['comment_url'],
+                    row['host'],
+                    row['video_url'],
+                    row['blocked'],
+                )
+            )
+            n_author_rows += 1
+            n_rows += 1
+        assert n_author_rows == n_expected
 
-    logger.info(
-        f'Exported {len(full_rows)} dead links from {PATH_OUT} as .CSV'
-    )
+    logger.info(f'Exported {n_rows} dead links from {PATH_OUT} as .CSV')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+import lxml.html
+import requests
+from lxml.etree import HTMLPullParser, XMLSyntaxError, XPath
+
+CHUNK_SIZE = 1 << 16  # bytes fed to the HTML parser at a time
+SKIPPED_TAGS = ('script', 'style')  # never queried, dropped while parsing
+
+
+def has_class(name: str) -> str:
+    """Build an XPath predicate equivalent to the CSS selector `.name`."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# Only the text of the last paginator link, which is the number of pages
+XP_LAST_PAGE = XPath(
+    f"string((//*[{has_class('pages')}]//li//a)[last()])", smart_strings=False
+)
+
+
+def declared_encoding(r: requests.Response) -> str | None:
+    """Get the charset of a response if its Content-Type header has one.
+
+    Without it, requests assumes ISO-8859-1 for any text/* response,
+    so in that case None is returned and libxml2 is left to read
+    the page's own <meta charset> instead.
+    """
+    content_type = r.headers.get('Content-Type', '')
+    return r.encoding if 'charset=' in content_type.lower() else None
+
+
+def parse_streamed(r: requests.Response) -> lxml.html.HtmlElement:
+    """Parse a streamed HTML response while its body is still arriving.
+
+    Only the parse tree is kept in memory, not a full copy of the body,
+    and parts of the page that are never queried are dropped from it
+    as soon as they are parsed. A response that isn't streamed is parsed
+    from its already loaded body the same way.
+
+    An empty or blank body gives an empty <html> element, so queries
+    on it find nothing instead of failing.
+    """
+    parser = HTMLPullParser(
+        events=('end',),
+        encoding=declared_encoding(r),
+        tag=SKIPPED_TAGS,
+        remove_comments=True,
+        remove_pis=True,
+    )
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+    for chunk in r.iter_content(CHUNK_SIZE):
+        parser.feed(chunk)
+        for _, el in parser.read_events():
+            el.clear(keep_tail=True)
+    try:
+        root = parser.close()
+    except XMLSyntaxError:  # nothing was fed at all
+        root = None
+    return lxml.html.Element('html') if root is None else root
@@ -1,52 +1,124 @@
+import sys
 from collections import Counter
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from pathlib import Path
 
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
+import requests_cache
+from lxml.etree import XPath
+from requests.adapters import HTTPAdapter
 
+from html_utils import XP_LAST_PAGE, has_class, parse_streamed
+from video_host_utils import RETRY, TIMEOUT, USER_AGENT
 
-def number_of_pages(movie: str) -> int:
-    """Get the total number of comment pages on a movie page."""
-    r = requests.get(f'https://www.icheckmovies.com/movies/{movie}/comments/')
-    if r.status_code != requests.codes.ok:
-        print(
-            f'Error while fetching the first page of comments on {movie}: '
-            f'HTTP error {r.status_code}'
-        )
-        return 0
-    soup = BeautifulSoup(r.text, 'html.parser')
-    paginator = soup.select('.pages li a')
-    return int(paginator[-1].get_text()) if paginator else 1
+URL_MOVIE_COMMENTS = 'https://www.icheckmovies.com/movies/{}/comments/'
+MAX_WORKERS = 8  # concurrent comment page fetches, shared by all movies
+MAX_MOVIE_WORKERS = 2  # movies crawled at once, kept low to spare the server
+CACHE_FILENAME = 'icm_cache.sqlite'
+CACHE_TTL = 24 * 60 * 60  # seconds a fetched page is reused on re-runs
+cache_path: Path = Path(__file__).resolve().parent / CACHE_FILENAME
+
+# Comment pages barely change within a day, so re-runs are served from disk
+SESSION = requests_cache.CachedSession(
+    cache_path, expire_after=CACHE_TTL, allowable_methods=('GET', 'HEAD')
+)
+SESSION.headers['User-Agent'] = USER_AGENT
+SESSION.mount(
+    'https://',
+    HTTPAdapter(
+        pool_connections=4,
+        # movie workers fetch the first page of each movie themselves
+        pool_maxsize=MAX_WORKERS + MAX_MOVIE_WORKERS,
+        max_retries=RETRY,
+    ),
+)
+
+# Started once and shared by all movies instead of a new pool per movie.
+# Movie workers only wait on it and never run on it, so it can't deadlock.
+PAGE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS, thread_name_prefix='page'
+)
+
+
+XP_MOVIES = XPath(
+    f"//*[{has_class('listItemMovie')}]//h2//a/@href", smart_strings=False
+)
+XP_COMMENTERS = XPath(f"//*[{has_class('comment')}]//h3//a")
+
+
+def fetch_and_parse(
+    movie: str, page: int = 1
+) -> tuple[lxml.html.HtmlElement, int]:
+    """Fetch and parse a page of comments on a movie.
+
+    The total number of comment pages is read from the paginator
+    of the same page, so no separate request is needed for it.
+    """
+    # Not streamed: the cached session reads the whole body anyway
+    # to store it, so it is parsed from the loaded response.
+    r = SESSION.get(
+        URL_MOVIE_COMMENTS.format(movie),
+        params={'page': page} if page > 1 else None,
+        timeout=TIMEOUT,
+    )
+    r.raise_for_status()
+    tree = parse_streamed(r)
+    last_page = XP_LAST_PAGE(tree)
+    return tree, int(last_page) if last_page else 1
+
+
+def names_of_commenters(tree: lxml.html.HtmlElement) -> list[str]:
+    return [el.text_content() for el in XP_COMMENTERS(tree)]
 
 
 def all_movies_on_a_list(url: str) -> Iterable[str]:
-    r = requests.get(url)
+    r = SESSION.get(url, timeout=TIMEOUT)
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, 'html.parser')
-    for el in soup.select('.listItemMovie h2 a'):
-        yield el['href'].replace('/movies/', '').rstrip('/')
+    for href in XP_MOVIES(parse_streamed(r)):
+        yield href.replace('/movies/', '').rstrip('/')
+
+
+def commenters_on_page(movie: str, page: int) -> list[str]:
+    return names_of_commenters(fetch_and_parse(movie, page)[0])
+
+
+def print_line(msg: str):
+    """Print a message from a movie worker in one piece.
+
+    print() writes the text and the newline separately, so lines
+    from concurrent movie workers could run into each other.
+    """
+    sys.stdout.write(msg + '\n')
 
 
 def commenters(movie: str) -> Counter:
-    n = number_of_pages(movie)
-    c = Counter()
-    print(f'Fetching {n} comment pages of "{movie}"')
-    for page in range(1, n + 1):
-        r = requests.get(
-            f'https://www.icheckmovies.com/movies/{movie}/comments/',
-            {'page': page},
+    try:
+        tree, n = fetch_and_parse(movie)
+    except requests.HTTPError as e:
+        print_line(
+            f'Error while fetching the first page of comments on {movie}: '
+            f'HTTP error {e.response.status_code}'
         )
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, 'html.parser')
-        c.update(el.get_text() for el in soup.select('.comment h3 a'))
-    return c
+        return Counter()
+    print_line(f'Fetching {n} comment pages of "{movie}"')
+    pages = PAGE_EXECUTOR.map(
+        lambda page: commenters_on_page(movie, page), range(2, n + 1)
+    )
+    # tallied in one pass over all names instead of one update per page
+    return Counter(chain(names_of_commenters(tree), *pages))
 
 
 def top_commenters_on_movies_in_a_list(
     url: str, min_comments: int = 0
 ) -> list[tuple[str, int]]:
-    counters = (commenters(m) for m in all_movies_on_a_list(url))
-    summary = sum(counters, Counter())
+    summary = Counter()
+    with ThreadPoolExecutor(max_workers=MAX_MOVIE_WORKERS) as executor:
+        # merged on this thread as results arrive, so no lock is needed
+        for c in executor.map(commenters, all_movies_on_a_list(url)):
+            summary.update(c)
     return [
         (el, cnt) for el, cnt in summary.most_common() if cnt > min_comments
     ]
@@ -1,22 +1,47 @@
+import itertools
 import re
-from collections.abc import Callable
-from functools import partial
+import time
+from collections.abc import Callable, Collection, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
 from pathlib import Path
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 YT_KEY_FILENAME = 'youtube_data_api.key'
+MAX_BATCH_SIZE = 50  # the most ids Youtube Data API accepts per request
+USER_AGENT = (
+    'icm-dead-video-links (+https://github.com/monk-time/icm-dead-video-links)'
+)
+TIMEOUT = (5, 30)  # (connect, read) in seconds
+MAX_WORKERS = 8  # concurrent checks of videos on hosts without a batch API
 yt_key_path: Path = Path(__file__).resolve().parent / YT_KEY_FILENAME
+AVAILABLE_VIDEOS_FILENAME = 'available_videos.txt'
+AVAILABLE_VIDEOS_TTL = 60 * 60  # seconds a video is trusted to stay up
+available_videos_path: Path = (
+    Path(__file__).resolve().parent / AVAILABLE_VIDEOS_FILENAME
+)
 
-if yt_key_path.exists():
-    YT_API_KEY = yt_key_path.read_text().strip()
-else:
-    msg = (
-        f'Create a file "{YT_KEY_FILENAME}" in the script directory\n'
-        f'and put your Google API key inside.\n'
-        'For more info: https://support.google.com/googleapi/answer/6158862'
-    )
-    raise FileNotFoundError(msg)
+
+@cache
+def yt_api_key() -> str:
+    """Read the Google API key, on first use instead of at import.
+
+    Raises:
+        FileNotFoundError: if there is no key file in the script directory.
+    """
+    if not yt_key_path.exists():
+        msg = (
+            f'Create a file "{YT_KEY_FILENAME}" in the script directory\n'
+            f'and put your Google API key inside.\n'
+            'For more info: '
+            'https://support.google.com/googleapi/answer/6158862'
+        )
+        raise FileNotFoundError(msg)
+    return yt_key_path.read_text().strip()
 
 
 def extract_video_ids(regex: re.Pattern, s: str):
@@ -29,37 +54,82 @@ PROXIES = {
     'https': 'https://proxy-ssl.antizapret.prostovpn.org:3143',
 }
 
+# Long-lived sessions reuse connections between checks: one for the video
+# hosts themselves and one for Youtube Data API on googleapis.com.
+SESSION = requests.Session()
+YT_SESSION = requests.Session()
+SESSION.headers['User-Agent'] = USER_AGENT
+YT_SESSION.headers['User-Agent'] = USER_AGENT
+# The one retry policy of every session, here and in the scripts.
+# Transient errors and rate limiting (honouring Retry-After) are retried
+# with a backoff. The last response is still returned rather than raised,
+# so callers report a page that keeps failing and move on, and a video
+# host that keeps failing counts as a dead link, as before.
+RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=('HEAD', 'GET'),
+    raise_on_status=False,
+)
+for prefix in ('https://', 'http://'):
+    # a pool per video host, each as large as the number of check workers
+    SESSION.mount(
+        prefix,
+        HTTPAdapter(
+            pool_connections=4, pool_maxsize=MAX_WORKERS, max_retries=RETRY
+        ),
+    )
+YT_SESSION.mount('https://', HTTPAdapter(max_retries=RETRY))
+
+# Started once and reused by every batch of one-by-one checks.
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS, thread_name_prefix='video-check'
+)
+
 
 def get_video_status(url: str, vid: str, *, use_proxy: bool = False) -> str:
-    """Check if a given video id is available by sending a HEAD request."""
-    r = requests.head(
+    """Check if a given video id is available by requesting its first byte.
+
+    Some hosts answer HEAD requests for dead videos with 200, while a GET
+    gets the real status. Hosts that honour the Range header send a single
+    byte of the page; for those that ignore it and send the whole page,
+    the streamed body is left unread.
+    """
+    with SESSION.get(
         url.format(vid),
+        headers={'Range': 'bytes=0-0'},
         allow_redirects=True,
+        stream=True,
         proxies=PROXIES if use_proxy else None,
-    )
-    return 'ok' if r.status_code == requests.codes.ok else 'not found'
+        timeout=TIMEOUT,
+    ) as r:
+        status_code = r.status_code
+        if status_code == requests.codes.partial_content:
+            # Reading the (one byte) body returns the connection to the pool;
+            # closing a response with an unread body drops the connection.
+            r.content  # noqa: B018
+    if status_code in {requests.codes.ok, requests.codes.partial_content}:
+        return 'ok'
+    return 'not found'
 
 
-def get_yt_video_status(ytid: str) -> str:  # noqa: PLR0911
-    """Check if a youtube video is available via Youtube Data API v3.
+def get_statuses_one_by_one(
+    get_status: Callable[[str], str], vids: Collection[str]
+) -> dict[str, str]:
+    """Check several videos of a host that has no batch API.
+
+    Each video still needs its own request, but they are sent concurrently.
+    """
+    return dict(zip(vids, EXECUTOR.map(get_status, vids), strict=True))
+
+
+def yt_video_info_status(video_info: dict) -> str:  # noqa: PLR0911
+    """Get a video status from its resource in a Youtube API response.
 
     Raises:
         RuntimeError: if received an unexpected Youtube API response.
     """
-    r = requests.get(
-        'https://www.googleapis.com/youtube/v3/videos',
-        {
-            'id': ytid,
-            'key': YT_API_KEY,
-            'part': 'status,contentDetails',
-            'fields': 'items(status,contentDetails/regionRestriction)',
-        },
-    )
-    r.raise_for_status()
-    yt_response = r.json()
-    if not yt_response['items']:
-        return 'not found'
-    video_info = yt_response['items'][0]
     status = video_info['status']
     if status['privacyStatus'] == 'private':
         return 'private'  # also can be: public, unlisted
@@ -90,8 +160,85 @@ def get_yt_video_status(ytid: str) -> str:  # noqa: PLR0911
             return 'blocked everywhere'
         return 'ok'
 
-    msg = f'Unexpected Youtube API response for {ytid}'
-    raise RuntimeError(msg, yt_response)
+    msg = f'Unexpected Youtube API response for {video_info["id"]}'
+    raise RuntimeError(msg, video_info)
+
+
+def get_yt_video_statuses(ytids: Collection[str]) -> dict[str, str]:
+    """Check youtube videos via Youtube Data API v3, 50 per request.
+
+    Raises:
+        RuntimeError: if received an unexpected Youtube API response.
+    """
+    # videos that don't exist are simply missing from the response
+    statuses = dict.fromkeys(ytids, 'not found')
+    # a repeated id would take up a slot in a batch for nothing
+    for chunk in itertools.batched(tuple(statuses), MAX_BATCH_SIZE):
+        r = YT_SESSION.get(
+            'https://www.googleapis.com/youtube/v3/videos',
+            params={
+                'id': ','.join(chunk),
+                'key': yt_api_key(),
+                'part': 'status,contentDetails',
+                'fields': 'items(id,status,contentDetails/regionRestriction)',
+            },
+            timeout=TIMEOUT,
+        )
+        r.raise_for_status()
+        for video_info in orjson.loads(r.content)['items']:
+            statuses[video_info['id']] = yt_video_info_status(video_info)
+    return statuses
+
+
+def get_yt_video_status(ytid: str) -> str:
+    """Check if a youtube video is available via Youtube Data API v3.
+
+    Raises:
+        RuntimeError: if received an unexpected Youtube API response.
+    """
+    return get_yt_video_statuses([ytid])[ytid]
+
+
+@cache
+def recently_available_videos() -> dict[str, int]:
+    """Load urls of videos that were available in recent runs.
+
+    Entries older than AVAILABLE_VIDEOS_TTL are skipped.
+    Only available videos are kept: dead ones are always checked again.
+    """
+    if not available_videos_path.exists():
+        return {}
+    now = time.time()
+    videos = {}
+    with available_videos_path.open(encoding='utf-8') as f:
+        for line in f:
+            checked_at, _, url = line.strip().partition(' ')
+            if not checked_at.isdigit():
+                continue  # e.g. a line cut short by an interrupted run
+            if now - int(checked_at) < AVAILABLE_VIDEOS_TTL:
+                videos[url] = int(checked_at)
+    return videos
+
+
+@cache
+def prune_available_videos():
+    """Rewrite the file without expired entries, once per run."""
+    videos = recently_available_videos()
+    with available_videos_path.open(mode='w', encoding='utf-8') as f:
+        f.writelines(f'{t} {url}\n' for url, t in videos.items())
+
+
+def remember_available_videos(urls: Iterable[str]):
+    """Save urls of videos found available, for the runs that follow.
+
+    Expired entries are dropped from the file before the first save.
+    """
+    now = int(time.time())
+    lines = [f'{now} {url}\n' for url in urls]
+    if lines:
+        prune_available_videos()
+        with available_videos_path.open(mode='a', encoding='utf-8') as f:
+            f.writelines(lines)
 
 
 class VideoHostToolset:
@@ -100,16 +247,53 @@ class VideoHostToolset:
         *,
         regex: re.Pattern,
         url: str,
+        marker: str,
         use_proxy: bool = False,
         get_status: Callable[[str], str] | None = None,
+        get_statuses: Callable[[Collection[str]], dict[str, str]]
+        | None = None,
     ):
         self.url = url
+        self.regex = regex
+        self.marker = marker  # a substring of every url the regex matches
         self.extract = partial(extract_video_ids, regex)
         self.get_status = (
             partial(get_video_status, url, use_proxy=use_proxy)
             if get_status is None
             else get_status
         )
+        self.fetch_statuses = (
+            partial(get_statuses_one_by_one, self.get_status)
+            if get_statuses is None
+            else get_statuses
+        )
+        # the same video is often linked in many comments
+        self.cache: dict[str, str] = {}
+
+    def get_statuses(self, vids: Collection[str]) -> dict[str, str]:
+        """Check several videos at once, reusing known statuses.
+
+        Videos found available by a recent run aren't checked again,
+        and a video repeated in vids is only checked once.
+        """
+        available = recently_available_videos()
+        unknown = []
+        for vid in dict.fromkeys(vids):
+            if vid in self.cache:
+                continue
+            if self.url.format(vid) in available:
+                self.cache[vid] = 'ok'
+            else:
+                unknown.append(vid)
+        if unknown:
+            statuses = self.fetch_statuses(unknown)
+            self.cache.update(statuses)
+            remember_available_videos(
+                self.url.format(vid)
+                for vid, status in statuses.items()
+                if status == 'ok'
+            )
+        return {vid: self.cache[vid] for vid in vids}
 
 
 RE_YT_ID = re.compile(
@@ -129,22 +313,44 @@ VIDEO_HOSTS = {
     'youtube': VideoHostToolset(
         regex=RE_YT_ID,
         url='https://www.youtube.com/watch?v={}',
+        marker='youtu',
         get_status=get_yt_video_status,
+        get_statuses=get_yt_video_statuses,
     ),
     'vimeo': VideoHostToolset(
-        regex=re.compile(r'vimeo\.com/(\d+)'), url='https://vimeo.com/{}'
+        regex=re.compile(r'vimeo\.com/(\d+)'),
+        url='https://vimeo.com/{}',
+        marker='vimeo.com/',
     ),
     'dailymotion': VideoHostToolset(
         regex=(re.compile(r'dailymotion\.com/video/([^"\s]+)')),
         url='https://www.dailymotion.com/video/{}',
+        marker='dailymotion.com/video/',
         use_proxy=True,
     ),
     'googlevideo': VideoHostToolset(
         regex=re.compile(r'video\.google\.com/videoplay\?.*?docid=([-0-9]+)'),
         url='http://video.google.com/videoplay?docid={}',
+        marker='video.google.com/videoplay',
     ),
 }
 
+
+def extract_all_video_ids(s: str) -> Iterator[tuple[str, str]]:
+    """Find (host, video id) pairs for all video urls in a text string.
+
+    Most comments have no video links at all, so a host's regex only runs
+    on text that contains its marker. The host regexes are not combined
+    into one alternation: a single scan can't return overlapping matches,
+    and a greedy pattern (or an id followed directly by the next url)
+    would hide a link to another host.
+    """
+    for name, host in VIDEO_HOSTS.items():
+        if host.marker in s:
+            for vid in host.extract(s):
+                yield name, vid
+
+
 if __name__ == '__main__':
     print(VIDEO_HOSTS['youtube'].get_status('dQw4w9WgXcQ'))  # ok
     print(